@@ -1,12 +1,15 @@
+import logging
 import os
 from pathlib import Path
-import requests
-import json
+
+import urllib3
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, A
 from biothings.web.settings.default import APP_LIST
 from web.service.umls_service import UMLSJsonFileClient, NarrowerRelationshipService
+from web.utils.http import download_file
 
+logger = logging.getLogger(__name__)
 
 ES_HOST = "http://localhost:9200"
 ES_INDEX = "pending-semmeddb"
@@ -28,11 +31,14 @@ _narrower_relationships_url = "https://raw.githubusercontent.com/biothings/node-
 if not os.path.exists(_narrower_relationships_folder):
     os.makedirs(_narrower_relationships_folder)
 
-if not os.path.exists(_narrower_relationships_filepath):
-    _response = requests.get(_narrower_relationships_url)
-    _response.raise_for_status()
-    with open(_narrower_relationships_filepath, "w") as _local_file:
-        json.dump(_response.json(), _local_file)
+# Only re-downloaded if the remote file has changed (conditional GET on its ETag).
+# If the remote file cannot be reached, fall back to the local copy when there is one.
+try:
+    download_file(_narrower_relationships_url, _narrower_relationships_filepath, conditional=True)
+except urllib3.exceptions.HTTPError as e:
+    if not os.path.exists(_narrower_relationships_filepath):
+        raise
+    logger.warning("Cannot update %s, using the local copy instead: %s", _narrower_relationships_filepath, e)
 
 _narrower_relationships_client = UMLSJsonFileClient(filepath=_narrower_relationships_filepath)
 _narrower_relationships_client.open_resource()
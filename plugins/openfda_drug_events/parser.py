@@ -0,0 +1,271 @@
+"""
+Parser for the openFDA Drug Adverse Events archives
+
+Turns the raw records of the `*.json.zip` archives into documents. It doesn't depend on
+the hub (only on the schema fields parsed by the uploader), so that the archives can be
+parsed in worker processes
+"""
+
+import itertools
+import logging
+import multiprocessing
+import queue
+import traceback
+from datetime import datetime
+from zipfile import ZipFile
+
+import ijson
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# values removed from the records, see DrugEventParser._normalize_record
+_EMPTY_VALUES = ("", None)
+
+# uncompressed json files up to this size are parsed with orjson, bigger ones are streamed with ijson
+_ORJSON_MAX_FILE_SIZE = 200 * 1024 * 1024  # in bytes
+
+
+def parse_date(date_str: str, sep: str = "") -> datetime | None:
+    """
+    parse date from string with `sep` separating year, month, and day
+
+    Returns:
+        datetime if date can be parsed
+        None otherwise
+    """
+    if len(date_str) == (8 + 2 * len(sep)):
+        date_obj = datetime.strptime(date_str, f"%Y{sep}%m{sep}%d")
+    elif len(date_str) == (6 + len(sep)):
+        date_obj = datetime.strptime(date_str, f"%Y{sep}%m")
+    elif len(date_str) == 4:
+        date_obj = datetime.strptime(date_str, "%Y")
+    else:
+        date_obj = None
+        logger.warning(f"Cannot parse date {date_str}")
+    return date_obj
+
+
+class DrugEventParser:
+    """
+    Turns the raw records of openFDA drug event archives into documents.
+    Only depends on the parsed schema fields, so that archives can be parsed in worker processes.
+    """
+
+    def __init__(self, int_fields, categorical_fields):
+        self.int_fields = int_fields
+        self.categorical_fields = categorical_fields
+        self._field_handlers = {}  # field name -> value handler (or None), filled by _process_field_vals
+
+    def parse_archive(self, file_path: str):
+        """yield the documents of a `*.json.zip` archive"""
+        with ZipFile(file_path) as zf:
+            for record in DrugEventParser._read_records(zf):
+                yield self.parse_record(record)
+
+    def parse_record(self, record):
+        """turn a raw record into a document, in place"""
+        self._normalize_record(record)
+
+        # normalize the top-level keys in place, rather than copying the record with dict_convert
+        for key in list(record):
+            new_key = _process_key(key)
+            if new_key != key:
+                record[new_key] = record.pop(key)
+        if "duplicate" in record.keys():
+            record["duplicate"] = record["duplicate"] == 1
+        record["_id"] = record["safetyreportid"]
+        return record
+
+    @staticmethod
+    def _read_records(zf: ZipFile):
+        """yield the records in the "results" array of the json file archived in `zf`"""
+        member = zf.infolist()[0]
+        if orjson is not None and member.file_size <= _ORJSON_MAX_FILE_SIZE:
+            # small enough to be parsed in one go, with the much faster orjson
+            yield from orjson.loads(zf.read(member))["results"]
+        else:
+            with zf.open(member) as json_fd:
+                # stream records out of the (lazily inflated) archive member instead of loading the
+                # whole "results" array; ijson uses its yajl2_c backend when available
+                yield from ijson.items(json_fd, "results.item", use_float=True)
+
+    def _normalize_record(self, record):
+        """
+        in a single iterative (in-place) pass over the record:
+        - remove empty values ("" or None), also from lists, and the lists and dicts left empty
+          (same as `dict_sweep(record, vals=["", None], remove_invalid_list=True)`)
+        - remove "*dateformat" fields, also from the dicts in nested lists
+        - process the leaf values with `_process_field_vals`
+        """
+        stack = [(record, True)]  # (dict, whether its leaf values are processed)
+        nested_dicts = []  # (parent, key) of all nested dicts, parents before children
+        dateformat_fields = []  # (parent, key) of "*dateformat" fields
+        while stack:
+            data, process_values = stack.pop()
+            for key, value in list(data.items()):
+                if value in _EMPTY_VALUES:
+                    del data[key]
+                    continue
+                if key.endswith("dateformat"):  # format codes of the date fields, e.g. "102"
+                    # removed at the end, but still swept like the rest of the record: the parent of a non-empty
+                    # "*dateformat" field is kept (even if left empty), but not the parent of a swept-out one
+                    dateformat_fields.append((data, key))
+                    process_item_values = False
+                else:
+                    process_item_values = process_values
+                if type(value) is dict:
+                    nested_dicts.append((data, key))
+                    stack.append((value, process_item_values))
+                elif type(value) is list:
+                    if any(item in _EMPTY_VALUES for item in value):
+                        value = data[key] = [item for item in value if item not in _EMPTY_VALUES]
+                    if not value:
+                        del data[key]
+                    else:
+                        for item in value:
+                            if type(item) is dict:
+                                stack.append((item, process_item_values))
+                            elif type(item) is list:
+                                # not swept nor processed (as dict_sweep and dict_traverse only go through the
+                                # dicts of a list), but their "*dateformat" fields are removed too
+                                DrugEventParser._remove_dateformat_fields(item)
+                elif process_item_values:
+                    data[key] = self._process_field_vals(key, value)[1]
+
+        # children before parents, so that a dict only left with empty dicts is removed too.
+        # dicts in lists are kept even if empty, as dict_sweep does
+        for data, key in reversed(nested_dicts):
+            if not data[key]:
+                del data[key]
+        # removed last, so that (like before) a dict with only "*dateformat" fields is left empty rather than removed
+        for data, key in dateformat_fields:
+            data.pop(key, None)  # may have been swept out above
+
+    @staticmethod
+    def _remove_dateformat_fields(data):
+        """remove the "*dateformat" fields of all the dicts nested in `data`"""
+        stack = [data]
+        while stack:
+            data = stack.pop()
+            if type(data) is dict:
+                for key in [key for key in data if key.endswith("dateformat")]:
+                    del data[key]
+                stack.extend(data.values())
+            elif type(data) is list:
+                stack.extend(data)
+
+    def _process_field_vals(self, k, v):
+        """process dates, integers and categorical values"""
+        try:
+            handler = self._field_handlers[k]
+        except KeyError:
+            handler = self._field_handlers[k] = self._get_field_handler(k)
+        return k, handler(v) if handler else v
+
+    def _get_field_handler(self, k):
+        """return the function processing the values of field `k`, or None if its values are kept as is"""
+        if k.endswith("date"):
+            return DrugEventParser._format_date
+        if k in self.int_fields:
+            return int
+        if k in self.categorical_fields:
+            return lambda v, mapping=self.categorical_fields[k]: mapping.get(v, v)
+        return None
+
+    @staticmethod
+    def _format_date(date_str: str) -> str:
+        """format date string `YYYY[MM[DD]]` as `YYYY[-MM[-DD]]`"""
+        date_obj = parse_date(date_str)
+        if len(date_str) == 8:
+            return date_obj.strftime("%Y-%m-%d")
+        elif len(date_str) == 6:
+            return date_obj.strftime("%Y-%m")
+        elif len(date_str) == 4:
+            return date_obj.strftime("%Y")
+        return date_str
+
+
+# processed record keys by raw key. openFDA records only have a few hundred distinct keys, so after the first records
+# every key is processed with a single dict lookup, without allocating new strings
+_PROCESSED_KEYS = {}
+
+
+def _process_key(key):
+    processed_key = _PROCESSED_KEYS.get(key)
+    if processed_key is None:
+        processed_key = _PROCESSED_KEYS[key] = key.replace(" ", "_").lower()
+    return processed_key
+
+
+def parse_archives(file_paths, int_fields, categorical_fields, n_workers=1, batch_size=1000, queue_size=4):
+    """
+    yield the documents of the `*.json.zip` archives in `file_paths`.
+
+    Inflating and parsing the archives is CPU-bound, so with `n_workers` > 1 they are parsed in that many worker
+    processes, which stream the records back in batches of `batch_size` records. Workers block while `queue_size`
+    batches are waiting to be yielded, which bounds the memory held by the parsed records.
+    """
+    if n_workers <= 1 or len(file_paths) <= 1:
+        parser = DrugEventParser(int_fields, categorical_fields)
+        for file_path in file_paths:
+            yield from parser.parse_archive(file_path)
+        return
+
+    # each worker gets its own share of the archives up front, so nothing is left to feed them when one fails
+    n_workers = min(n_workers, len(file_paths))
+    # forked explicitly (fork is no longer the default start method from Python 3.14), so that the workers
+    # don't have to re-import this plugin module
+    mp_context = multiprocessing.get_context("fork")
+    batch_queue = mp_context.Queue(maxsize=queue_size)
+    workers = [
+        mp_context.Process(
+            target=_parse_archives,
+            args=(file_paths[i::n_workers], batch_queue, int_fields, categorical_fields, batch_size),
+        )
+        for i in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        n_running = n_workers
+        while n_running:
+            try:
+                batch = batch_queue.get(timeout=10)
+            except queue.Empty:
+                if any(worker.exitcode for worker in workers):
+                    raise RuntimeError("openFDA archive parsing worker died unexpectedly")
+                continue
+            if batch is None:  # a worker is done
+                n_running -= 1
+            elif isinstance(batch, str):
+                raise RuntimeError(f"Failed to parse openFDA archive in worker process:\n{batch}")
+            else:
+                yield from batch
+    finally:
+        # also when the generator is closed early, the workers may be blocked on the full batch queue
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
+def _parse_archives(file_paths, batch_queue, int_fields, categorical_fields, batch_size):
+    """
+    parse the archives of `file_paths` in a worker process, see parse_archives.
+    Put their records in `batch_queue` as lists of `batch_size` records, then a None when done, or the formatted
+    traceback if an archive cannot be parsed
+    """
+    parser = DrugEventParser(int_fields, categorical_fields)
+    try:
+        for file_path in file_paths:
+            records = parser.parse_archive(file_path)
+            while batch := list(itertools.islice(records, batch_size)):
+                batch_queue.put(batch)
+    except Exception:
+        batch_queue.put(traceback.format_exc())
+    batch_queue.put(None)
@@ -6,22 +6,44 @@ from the dumper class instance
 """
 
 import copy
+import fcntl
 import glob
-import json
+import itertools
 import os
-import urllib.request
-from datetime import datetime
-from zipfile import ZipFile
+import pickle
+import time
+from pathlib import Path
 
 import biothings.hub
 import biothings.hub.dataload.uploader
+import urllib3
 import yaml
 from biothings import config
 from biothings.hub.dataload import storage
-from biothings.utils.dataload import dict_convert, dict_sweep, dict_traverse
+
+from .parser import parse_archives, parse_date
+
+try:
+    # libyaml-backed loader, several times faster than the pure-Python one
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 logger = config.logger
 
+# parsed record schema is cached on disk and revalidated against openFDA once a week
+_SCHEMA_CACHE_PATH = Path(config.DATA_ARCHIVE_ROOT) / "openfda_drug_events" / "drugevent_schema.pkl"
+_SCHEMA_CACHE_TTL = 7 * 24 * 60 * 60  # in seconds
+
+# module-level pool so that repeated uploader instantiations reuse the TLS connection to openFDA;
+# the schema is fetched while holding the cache lock, so a stalled connection must not block forever
+_HTTP_POOL = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=8,
+    retries=urllib3.Retry(3, backoff_factor=0.2),
+    timeout=urllib3.Timeout(connect=10, read=30),
+)
+
 
 class MostRecentStorage(storage.MergerStorage):
     """
@@ -66,82 +88,101 @@ class OpenFDADrugUploader(biothings.hub.dataload.uploader.BaseSourceUploader):
     # CheckSizeStorage is also used to skip massive records
     storage_class = (MostRecentStorage, storage.CheckSizeStorage)
 
+    # number of worker processes parsing the archives in load_data, 1 to parse them sequentially in this process.
+    # Kept low, as the hub already runs several uploaders in parallel
+    MAX_PARSE_WORKERS = 2
+    # the workers send the parsed records back in batches of PARSE_BATCH_SIZE records, and block while
+    # PARSE_QUEUE_SIZE batches are waiting to be yielded, which bounds the memory held by the parsed records
+    PARSE_BATCH_SIZE = 1000
+    PARSE_QUEUE_SIZE = 4
+
     def __init__(self, db_conn_info, collection_name=None, log_folder=None, *args, **kwargs):
         # NOTE: using hardcoded URL for record schema
         if not self.RECORD_SCHEMA_URL.startswith("https://"):
             raise ValueError(f"Only HTTPS allowed for accessing openFDA, found {self.RECORD_SCHEMA_URL}")
-        with urllib.request.urlopen(self.RECORD_SCHEMA_URL) as response:  # nosec B310 - checked before
-            schema = yaml.safe_load(response.read().decode("utf-8"))
-        self.int_fields, self.categorical_fields = OpenFDADrugUploader._parse_schema(schema)
+        self.int_fields, self.categorical_fields = self._load_schema_fields()
         super().__init__(db_conn_info, collection_name, log_folder, *args, **kwargs)
 
-    def load_data(self, data_folder: str):
-        process_key = lambda key: key.replace(" ", "_").lower()
-
-        for file_path in glob.glob(os.path.join(data_folder, "*.json.zip")):
-            with ZipFile(file_path) as zf:
-                with zf.open(zf.namelist()[0]) as json_fd:
-                    records = json.load(json_fd)["results"]
-                    for record in records:
-                        record = dict_sweep(record, vals=["", None], remove_invalid_list=True)
-                        OpenFDADrugUploader._remove_dateformat_fields(record)
-                        dict_traverse(record, self._process_field_vals, traverse_list=True)
-
-                        record = dict_convert(record, process_key)
-                        if "duplicate" in record.keys():
-                            record["duplicate"] = record["duplicate"] == 1
-                        record["_id"] = record["safetyreportid"]
-
-                        yield record
-
-    def _process_field_vals(self, k, v):
-        """process dates, integers and categorical values"""
-        new_val = v
-        if k.endswith("date"):
-            date_obj = OpenFDADrugUploader.parse_date(v)
-            if len(v) == 8:
-                new_val = date_obj.strftime("%Y-%m-%d")
-            elif len(v) == 6:
-                new_val = date_obj.strftime("%Y-%m")
-            elif len(v) == 4:
-                new_val = date_obj.strftime("%Y")
-        elif k in self.int_fields:
-            new_val = int(v)
-        elif k in self.categorical_fields.keys() and v in self.categorical_fields[k].keys():
-            new_val = self.categorical_fields[k][v]
-        return k, new_val
-
-    @staticmethod
-    def parse_date(date_str: str, sep: str = "") -> datetime | None:
+    def _load_schema_fields(self):
         """
-        parse date from string with `sep` separating year, month, and day
-
-        Returns:
-            datetime if date can be parsed
-            None otherwise
+        get int and categorical fields of the record schema, from the on-disk cache if it's
+        fresh enough, otherwise from openFDA (using a conditional GET when a stale cache exists).
+        A file lock is held meanwhile so concurrent uploaders don't race on the cache file.
         """
-        if len(date_str) == (8 + 2 * len(sep)):
-            date_obj = datetime.strptime(date_str, f"%Y{sep}%m{sep}%d")
-        elif len(date_str) == (6 + len(sep)):
-            date_obj = datetime.strptime(date_str, f"%Y{sep}%m")
-        elif len(date_str) == 4:
-            date_obj = datetime.strptime(date_str, "%Y")
-        else:
-            date_obj = None
-            logger.warning(f"Cannot parse date {date_str}")
-        return date_obj
+        _SCHEMA_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(_SCHEMA_CACHE_PATH.with_suffix(".lock"), "w") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+            cached = None
+            try:
+                with open(_SCHEMA_CACHE_PATH, "rb") as cache_fd:
+                    cached = pickle.load(cache_fd)
+            except FileNotFoundError:
+                pass
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.warning(f"Ignoring unreadable schema cache {_SCHEMA_CACHE_PATH}: {e}")
+
+            if cached is not None and time.time() - _SCHEMA_CACHE_PATH.stat().st_mtime < _SCHEMA_CACHE_TTL:
+                return cached["int_fields"], cached["categorical_fields"]
+
+            headers = {}
+            if cached is not None:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
+            try:
+                # RECORD_SCHEMA_URL is checked to be HTTPS in __init__
+                response = _HTTP_POOL.request("GET", self.RECORD_SCHEMA_URL, headers=headers, preload_content=False)
+                try:
+                    if response.status == 304 and cached is not None:
+                        # schema not modified, renew the cache
+                        _SCHEMA_CACHE_PATH.touch()
+                        return cached["int_fields"], cached["categorical_fields"]
+                    if response.status != 200:
+                        raise urllib3.exceptions.HTTPError(
+                            f"GET {self.RECORD_SCHEMA_URL} failed with status {response.status}"
+                        )
+                    schema = yaml.load(response, Loader=SafeLoader)
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                finally:
+                    response.release_conn()
+            except urllib3.exceptions.HTTPError as e:
+                # also covers the connect/read timeouts of _HTTP_POOL
+                if cached is None:
+                    raise
+                logger.warning(f"Cannot revalidate openFDA schema, using the stale cache instead: {e}")
+                return cached["int_fields"], cached["categorical_fields"]
+
+            int_fields, categorical_fields = OpenFDADrugUploader._parse_schema(schema)
+            tmp_path = _SCHEMA_CACHE_PATH.with_suffix(".tmp")
+            with open(tmp_path, "wb") as cache_fd:
+                pickle.dump(
+                    {
+                        "etag": etag,
+                        "last_modified": last_modified,
+                        "int_fields": int_fields,
+                        "categorical_fields": categorical_fields,
+                    },
+                    cache_fd,
+                )
+            os.replace(tmp_path, _SCHEMA_CACHE_PATH)
+            return int_fields, categorical_fields
 
-    @staticmethod
-    def _remove_dateformat_fields(data):
-        if isinstance(data, dict):
-            keys_to_remove = [key for key in data if key.endswith("dateformat")]
-            for key in keys_to_remove:
-                del data[key]
-            for key, value in data.items():
-                OpenFDADrugUploader._remove_dateformat_fields(value)
-        elif isinstance(data, list):
-            for item in data:
-                OpenFDADrugUploader._remove_dateformat_fields(item)
+    def load_data(self, data_folder: str):
+        file_paths = glob.glob(os.path.join(data_folder, "*.json.zip"))
+        yield from parse_archives(
+            file_paths,
+            self.int_fields,
+            self.categorical_fields,
+            n_workers=self.MAX_PARSE_WORKERS,
+            batch_size=self.PARSE_BATCH_SIZE,
+            queue_size=self.PARSE_QUEUE_SIZE,
+        )
+
+    # also used by MostRecentStorage
+    parse_date = staticmethod(parse_date)
 
     @staticmethod
     def _parse_schema(schema):
@@ -153,21 +194,24 @@ class OpenFDADrugUploader(biothings.hub.dataload.uploader.BaseSourceUploader):
         int_fields = set()
         categorical_fields = {}
 
-        def recursive_parser(data):
-            if isinstance(data, dict):
-                for k, v in data.items():
-                    if isinstance(v, dict):
-                        if isinstance(v.get("possible_values"), dict):
-                            if v["possible_values"].get("type") == "one_of":
-                                categorical_fields[k] = v["possible_values"]["value"]
-                        if "int" in str(v.get("format")):
-                            int_fields.add(k)  # str() to diffuse format being null
-                        recursive_parser(v)
-                    elif isinstance(v, list):
-                        for list_val in v:
-                            recursive_parser(list_val)
-
-        recursive_parser(schema)
-        int_fields.remove("drugintervaldosageunitnumb")  # mixed with floats
-        int_fields.remove("drugseparatedosagenumb")  # mixed with floats
+        # depth-first walk with a stack of (key, value) iterators, visiting the fields in the same order as recursion
+        stack = [iter(schema.items())]
+        while stack:
+            for k, v in stack[-1]:
+                if type(v) is dict:
+                    possible_values = v.get("possible_values")
+                    if type(possible_values) is dict and possible_values.get("type") == "one_of":
+                        categorical_fields[k] = possible_values["value"]
+                    if "int" in str(v.get("format")):
+                        int_fields.add(k)  # str() to diffuse format being null
+                    stack.append(iter(v.items()))
+                    break
+                elif type(v) is list:
+                    stack.append(itertools.chain.from_iterable(item.items() for item in v if type(item) is dict))
+                    break
+            else:
+                stack.pop()
+
+        int_fields.discard("drugintervaldosageunitnumb")  # mixed with floats
+        int_fields.discard("drugseparatedosagenumb")  # mixed with floats
         return int_fields.difference(categorical_fields.keys()), categorical_fields
@@ -0,0 +1,70 @@
+"""
+Tests for the Annotator query batching, with a stubbed biothings client
+"""
+
+import asyncio
+
+import pytest
+
+from web.handlers.annotator import Annotator
+from web.utils import LRUCache
+
+
+class StubClient:
+    """records the querymany calls and returns one chembl doc per query id"""
+
+    def __init__(self):
+        self.calls = []
+
+    def querymany(self, query_list, scopes=None, fields=None):
+        self.calls.append(list(query_list))
+        return [
+            {"query": query_id, "_id": query_id, "chembl": {"drug_indications": [{"mesh_id": "D000001"}]}}
+            for query_id in query_list
+        ]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    stub_client = StubClient()
+    monkeypatch.setattr(Annotator, "annotation_cache", LRUCache(capacity=100))
+    monkeypatch.setattr(Annotator, "get_client", lambda self, node_type: stub_client)
+    return stub_client
+
+
+def test_duplicated_query_id_queried_once(client):
+    """PUBCHEM.COMPOUND:2 and UNII:2 share the query id "2", which is queried once and annotates both nodes"""
+    trapi_input = {"message": {"knowledge_graph": {"nodes": {"PUBCHEM.COMPOUND:2": {}, "UNII:2": {}}}}}
+    node_d = asyncio.run(Annotator().annotate_trapi(trapi_input))
+
+    assert client.calls == [["2"]]
+    assert node_d["PUBCHEM.COMPOUND:2"]["attributes"] == node_d["UNII:2"]["attributes"]
+    annotation = node_d["UNII:2"]["attributes"][0]["value"][0]
+    assert annotation["_id"] == "2"
+    assert annotation["chembl"]["drug_indications"][0]["mesh_id"] == "MESH:D000001"
+
+
+def test_cached_query_ids_skip_querymany(client):
+    annotator = Annotator()
+    annotator.query_biothings("chem", ["1", "2"])
+    res = annotator.query_biothings("chem", ["2", "3"])
+
+    assert client.calls == [["1", "2"], ["3"]]
+    assert set(res) == {"2", "3"}
+
+    annotator.query_biothings("chem", ["1", "2", "3"])
+    assert len(client.calls) == 2
+
+
+def test_cached_annotations_not_transformed(client):
+    """the annotations are transformed in-place, which must not alter the cached docs"""
+    trapi_input = {"message": {"knowledge_graph": {"nodes": {"PUBCHEM.COMPOUND:1": {}}}}}
+    for _ in range(2):
+        node_d = asyncio.run(Annotator().annotate_trapi(trapi_input))
+        annotation = node_d["PUBCHEM.COMPOUND:1"]["attributes"][0]["value"][0]
+        assert annotation["chembl"]["drug_indications"][0]["mesh_id"] == "MESH:D000001"
+    assert client.calls == [["1"]]
+
+    res = Annotator().query_biothings("chem", ["1"])
+    assert res["1"][0]["chembl"]["drug_indications"][0]["mesh_id"] == "D000001"
+    assert len(client.calls) == 1
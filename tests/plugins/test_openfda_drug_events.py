@@ -0,0 +1,169 @@
+"""
+Regression tests for the openFDA drug event record normalization, against the
+dict_sweep/dict_traverse/dict_convert pipeline it replaced
+"""
+
+import copy
+import importlib.util
+import json
+import multiprocessing
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from biothings.utils.dataload import dict_convert, dict_sweep, dict_traverse
+
+# loaded from its path, as importing the plugin package also imports its dumper and uploader, which need a hub config
+_PARSER_PATH = Path(__file__).parents[2] / "plugins" / "openfda_drug_events" / "parser.py"
+_spec = importlib.util.spec_from_file_location("openfda_drug_events_parser", _PARSER_PATH)
+parser = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(parser)
+
+INT_FIELDS = {"patientonsetage", "drugcumulativedosagenumb"}
+CATEGORICAL_FIELDS = {
+    "serious": {"1": "The adverse event resulted in death, a life threatening condition, ...", "2": "No"},
+    "drugcharacterization": {"1": "Suspect", "2": "Concomitant", "3": "Interacting"},
+}
+
+
+def _remove_dateformat_fields(data):
+    if isinstance(data, dict):
+        keys_to_remove = [key for key in data if key.endswith("dateformat")]
+        for key in keys_to_remove:
+            del data[key]
+        for key, value in data.items():
+            _remove_dateformat_fields(value)
+    elif isinstance(data, list):
+        for item in data:
+            _remove_dateformat_fields(item)
+
+
+def _process_field_vals(k, v):
+    new_val = v
+    if k.endswith("date"):
+        date_obj = parser.parse_date(v)
+        if len(v) == 8:
+            new_val = date_obj.strftime("%Y-%m-%d")
+        elif len(v) == 6:
+            new_val = date_obj.strftime("%Y-%m")
+        elif len(v) == 4:
+            new_val = date_obj.strftime("%Y")
+    elif k in INT_FIELDS:
+        new_val = int(v)
+    elif k in CATEGORICAL_FIELDS.keys() and v in CATEGORICAL_FIELDS[k].keys():
+        new_val = CATEGORICAL_FIELDS[k][v]
+    return k, new_val
+
+
+def reference_parse_record(record):
+    """the record processing of the uploader before DrugEventParser"""
+    record = dict_sweep(record, vals=["", None], remove_invalid_list=True)
+    _remove_dateformat_fields(record)
+    dict_traverse(record, _process_field_vals, traverse_list=True)
+
+    record = dict_convert(record, lambda key: key.replace(" ", "_").lower())
+    if "duplicate" in record.keys():
+        record["duplicate"] = record["duplicate"] == 1
+    record["_id"] = record["safetyreportid"]
+    return record
+
+
+RECORDS = [
+    {
+        "safetyreportid": "10003301",
+        "safetyreportversion": "1",
+        "receivedate": "20140306",
+        "receivedateformat": "102",
+        "serious": "1",
+        "duplicate": "1",
+        "Report Source": "",
+        "reportduplicate": {"duplicatesource": "NOVARTIS", "duplicatenumb": "PHHY2014CA026430"},
+        "primarysource": {"qualification": None, "reportercountry": "CA"},
+        "patient": {
+            "patientonsetage": "58",
+            "patientonsetageunit": "801",
+            "patientweight": "72.5",
+            "reaction": [{"reactionmeddrapt": "Pneumonia", "reactionoutcome": ""}],
+            "drug": [
+                {
+                    "drugcharacterization": "1",
+                    "medicinalproduct": "EXJADE",
+                    "drugstartdate": "201312",
+                    "drugstartdateformat": "610",
+                    "drugenddate": "2014",
+                    "drugcumulativedosagenumb": "3",
+                    "openfda": {"route": ["ORAL", "", None], "generic_name": ["DEFERASIROX"], "spl_id": []},
+                },
+                {"drugcharacterization": "4", "drugindication": None, "activesubstance": {}},
+            ],
+            "summary": {"narrativeincludeclinical": ""},
+        },
+    },
+    # empty lists
+    {"safetyreportid": "1", "Empty List": [], "list": ["", None], "patient": {"drug": []}},
+    # empty nested dicts, also left empty by the sweep
+    {"safetyreportid": "2", "empty": {}, "patient": {"summary": {"a": {"b": None}}, "patientsex": "1"}},
+    # dicts in lists, kept even if swept empty
+    {"safetyreportid": "3", "patient": {"drug": [{"drugindication": ""}, {}, {"a": {"b": ""}}, "x"]}},
+    # dicts with only dateformat fields, or with empty dateformat fields
+    {"safetyreportid": "4", "Y Key": {"somedateformat": {}}},
+    {"safetyreportid": "5", "Y Key": {"somedateformat": "102"}, "Z Key": {"otherdateformat": ""}},
+    {"safetyreportid": "6", "Y Key": {"somedateformat": {"a": None}}, "Z Key": {"otherdateformat": ["", None]}},
+    {"safetyreportid": "7", "Y Key": {"somedateformat": {"somedate": "2020"}}, "Z Key": [{"xdateformat": []}]},
+    # dicts in nested lists, which are not swept nor processed, but still lose their dateformat fields
+    {
+        "safetyreportid": "8",
+        "b": {"x": [[{"somedateformat": "1", "a": "v", "somedate": "2020"}, [{"ydateformat": ""}]]]},
+    },
+]
+
+
+@pytest.mark.parametrize("record", RECORDS, ids=[record["safetyreportid"] for record in RECORDS])
+def test_parse_record(record):
+    drug_event_parser = parser.DrugEventParser(INT_FIELDS, CATEGORICAL_FIELDS)
+    assert drug_event_parser.parse_record(copy.deepcopy(record)) == reference_parse_record(copy.deepcopy(record))
+
+
+def _write_archive(file_path, records):
+    with zipfile.ZipFile(file_path, "w") as zf:
+        zf.writestr("drug-event.json", json.dumps({"meta": {}, "results": records}))
+    return str(file_path)
+
+
+@pytest.fixture
+def archive_paths(tmp_path):
+    return [
+        _write_archive(tmp_path / f"drug-event-{i}.json.zip", copy.deepcopy(RECORDS[i : i + 3]))
+        for i in range(0, len(RECORDS), 3)
+    ]
+
+
+def test_parse_archives_in_workers(archive_paths):
+    sequential_docs = list(parser.parse_archives(archive_paths, INT_FIELDS, CATEGORICAL_FIELDS))
+    parallel_docs = list(
+        parser.parse_archives(archive_paths * 10, INT_FIELDS, CATEGORICAL_FIELDS, n_workers=2, batch_size=2)
+    )
+
+    assert len(sequential_docs) == len(RECORDS)
+    assert sorted(parallel_docs, key=repr) == sorted(sequential_docs * 10, key=repr)
+    assert not multiprocessing.active_children()
+
+
+def test_parse_archives_in_workers_failure(archive_paths, tmp_path):
+    bad_archive_path = tmp_path / "bad.json.zip"
+    bad_archive_path.write_text("not a zip file")
+    # more archives than a pipe buffer can hold paths for
+    file_paths = [str(bad_archive_path)] + archive_paths * 1000
+
+    with pytest.raises(RuntimeError, match="BadZipFile"):
+        for _ in parser.parse_archives(file_paths, INT_FIELDS, CATEGORICAL_FIELDS, n_workers=2, batch_size=2):
+            pass
+    assert not multiprocessing.active_children()
+
+
+def test_parse_archives_in_workers_closed_early(archive_paths):
+    docs = parser.parse_archives(archive_paths * 1000, INT_FIELDS, CATEGORICAL_FIELDS, n_workers=2, batch_size=2)
+    next(docs)
+    docs.close()
+    assert not multiprocessing.active_children()
@@ -2,16 +2,25 @@
 Translator Node Annotator Service Handler
 """
 
-import inspect
+import asyncio
+import copy
+import dbm
+import functools
+import glob
 import logging
 import os.path
 import shelve
+import threading
+import time
+from collections import defaultdict
 
 import biothings_client
 from biothings.utils.common import get_dotfield_value
 from biothings.web.handlers import BaseAPIHandler
 from tornado.web import HTTPError
 
+from web.utils import LRUCache
+
 logger = logging.getLogger(__name__)
 
 BIOLINK_PREFIX_to_BioThings = {
@@ -34,6 +43,12 @@ BIOLINK_PREFIX_to_BioThings = {
     "HP": {"type": "phenotype", "field": "hp", "keep_prefix": True},
 }
 
+# BIOLINK_PREFIX_to_BioThings flattened for parse_curie, prefix -> (type, keep_prefix, converter)
+_PREFIX_TABLE = {
+    prefix: (v.get("type"), v.get("keep_prefix", False), v.get("converter"))
+    for prefix, v in BIOLINK_PREFIX_to_BioThings.items()
+}
+
 # ANNOTAION_FIELD_TRANSFORMATION = {
 #     "chembl.drug_indications.mesh_id": lambda x: append_prefix(x, "MESH"),
 # }
@@ -53,6 +68,20 @@ def save_atc_cache():
 
 
 class ResponseTransformer:
+    # all _transform_* methods with their _TRANSFORM_KEYS (or None), collected once after the class body (see below)
+    # instead of reflecting over the instance for every transformed doc
+    _TRANSFORMS = ()
+    # the top-level doc keys a _transform_* method depends on, it's skipped for the docs without any of them.
+    # The _transform_* methods not listed here are applied to every doc.
+    _TRANSFORM_KEYS = {
+        "_transform_chembl_drug_indications": frozenset(["chembl"]),
+        "_transform_atc_classifications": frozenset(["chembl", "pharmgkb"]),
+    }
+    # WHO ATC codes, loaded from the "atc_cache.db" shelve into a dict shared by all instances,
+    # and reloaded when the shelve file is modified (e.g. regenerated by save_atc_cache)
+    _atc_cache = {}
+    _atc_cache_mtime = None
+
     def __init__(self, res_by_id, node_type):
         self.res_by_id = res_by_id
         self.node_type = node_type
@@ -61,9 +90,29 @@ class ResponseTransformer:
         # typically those data coming from other biothings APIs, we will do a batch
         # query to get them all, and cache them here for later use, to avoid slow
         # one by one queries.
-        self.atc_cache = {}  # cache for WHO ATC codes
-        if os.path.exists("atc_cache.db"):
-            self.atc_cache = shelve.open("atc_cache.db", "r")
+        self.atc_cache = self.get_atc_cache()  # cache for WHO ATC codes
+
+    @classmethod
+    def get_atc_cache(cls):
+        """return the shared WHO atc cache, or an empty dict if "atc_cache.db" is not available yet"""
+        try:
+            # depending on the dbm backend, the shelve is "atc_cache.db" or e.g. "atc_cache.db.dat" + "atc_cache.db.dir"
+            mtime = max((os.path.getmtime(path) for path in glob.glob("atc_cache.db*")), default=None)
+        except OSError:
+            mtime = None
+        if mtime is None:
+            return cls._atc_cache
+        if mtime != cls._atc_cache_mtime:
+            try:
+                # the shelve is closed right away, so it never holds a lock against save_atc_cache
+                with shelve.open("atc_cache.db", "r") as db:
+                    cls._atc_cache = dict(db)
+            except dbm.error as e:
+                # e.g. locked while being regenerated, keep the previous table and retry on the next call
+                logger.warning(f"Cannot load atc_cache.db: {e}")
+            else:
+                cls._atc_cache_mtime = mtime
+        return cls._atc_cache
 
     def _transform_chembl_drug_indications(self, doc):
         if self.node_type != "chem":
@@ -214,12 +263,18 @@ class ResponseTransformer:
 
     def transform_one_doc(self, doc):
         """transform the response from biothings client"""
-        for fn_name, fn in inspect.getmembers(self, predicate=inspect.ismethod):
-            if fn_name.startswith("_transform_"):
-                if isinstance(doc, list):
-                    doc = [fn(r) for r in doc]
-                else:
-                    doc = fn(doc)
+        if isinstance(doc, list):
+            doc_keys = set().union(*(r.keys() for r in doc))
+        else:
+            doc_keys = doc.keys()
+        for fn, fn_keys in self._TRANSFORMS:
+            if fn_keys is not None and doc_keys.isdisjoint(fn_keys):
+                # nothing to transform in this doc
+                continue
+            if isinstance(doc, list):
+                doc = [fn(self, r) for r in doc]
+            else:
+                doc = fn(self, doc)
         return doc
 
     def transform(self):
@@ -232,6 +287,14 @@ class ResponseTransformer:
                 res = self.transform_one_doc(res)
 
 
+# sorted by name, the same order inspect.getmembers used to yield them
+ResponseTransformer._TRANSFORMS = tuple(
+    (fn, ResponseTransformer._TRANSFORM_KEYS.get(fn_name))
+    for fn_name, fn in sorted(vars(ResponseTransformer).items())
+    if fn_name.startswith("_transform_")
+)
+
+
 class TRAPIInputError(ValueError):
     pass
 
@@ -241,14 +304,10 @@ class InvalidCurieError(ValueError):
 
 
 def list2dict(li, key):
-    out = {}
+    out = defaultdict(list)
     for d in li:
-        k = d[key]
-        if k not in out:
-            out[k] = [d]
-        else:
-            out[k].append(d)
-    return out
+        out[d[key]].append(d)
+    return dict(out)
 
 
 def append_prefix(id, prefix):
@@ -258,7 +317,29 @@ def append_prefix(id, prefix):
     return f"{prefix}:{id}" if not id.startswith(prefix) else id
 
 
+@functools.lru_cache(maxsize=65536)
+def parse_curie(curie):
+    """return the (type, query id) tuple of the input curie, type is None if the curie prefix is not supported.
+    Memoized, since the same curies are seen again and again across TRAPI messages.
+    """
+    if ":" not in curie:
+        raise InvalidCurieError(f"Invalid input curie id: {curie}")
+    _prefix, _id = curie.split(":", 1)
+    _type, keep_prefix, cvtr = _PREFIX_TABLE.get(_prefix, (None, False, None))
+    if not _type or keep_prefix:
+        _id = curie
+    if cvtr:
+        _id = cvtr(curie)
+    return _type, _id
+
+
 class Annotator:
+    # annotations returned by query_biothings, keyed by (node_type, query_id, fields) and shared by all instances,
+    # so that the commonly re-asked curies are not queried again until the entries expire
+    annotation_cache = LRUCache(capacity=50000)
+    annotation_cache_ttl = 3600  # in seconds
+    annotation_cache_lock = threading.Lock()
+
     annotator_clients = {
         "gene": {
             "client": {"biothing_type": "gene"},  # the kwargs passed to biothings_client.get_client
@@ -395,16 +476,7 @@ class Annotator:
 
     def parse_curie(self, curie, return_type=True, return_id=True):
         """return a both type and if (as a tuple) or either based on the input curie"""
-        if ":" not in curie:
-            raise InvalidCurieError(f"Invalid input curie id: {curie}")
-        _prefix, _id = curie.split(":", 1)
-        _type = BIOLINK_PREFIX_to_BioThings.get(_prefix, {}).get("type", None)
-        if return_id:
-            if not _type or BIOLINK_PREFIX_to_BioThings[_prefix].get("keep_prefix", False):
-                _id = curie
-            cvtr = BIOLINK_PREFIX_to_BioThings.get(_prefix, {}).get("converter", None)
-            if cvtr:
-                _id = cvtr(curie)
+        _type, _id = parse_curie(curie)
         if return_type and return_id:
             return _type, _id
         elif return_type:
@@ -423,11 +495,38 @@ class Annotator:
             return {}
         fields = fields or self.annotator_clients[node_type]["fields"]
         scopes = self.annotator_clients[node_type]["scopes"]
-        logger.info("Querying annotations for %s %ss...", len(query_list), node_type)
-        res = client.querymany(query_list, scopes=scopes, fields=fields)
-        logger.info("Done. %s annotation objects returned.", len(res))
-        res = list2dict(res, "query")
-        return res
+        fields_key = fields if isinstance(fields, str) else tuple(fields)
+
+        # only query the ids not cached yet (or expired)
+        res = {}
+        miss_list = []
+        now = time.monotonic()
+        with self.annotation_cache_lock:
+            for query_id in query_list:
+                cached = self.annotation_cache.get((node_type, query_id, fields_key))
+                if cached is not None and cached[0] > now:
+                    res[query_id] = cached[1]
+                else:
+                    miss_list.append(query_id)
+
+        if miss_list:
+            logger.info(
+                "Querying annotations for %s %ss (%s cached)...",
+                len(miss_list),
+                node_type,
+                len(query_list) - len(miss_list),
+            )
+            hits = client.querymany(miss_list, scopes=scopes, fields=fields)
+            logger.info("Done. %s annotation objects returned.", len(hits))
+            hits = list2dict(hits, "query")
+            expires_at = now + self.annotation_cache_ttl
+            with self.annotation_cache_lock:
+                for query_id, docs in hits.items():
+                    self.annotation_cache.put((node_type, query_id, fields_key), (expires_at, docs))
+            res.update(hits)
+
+        # the returned docs are transformed in-place later, so never hand out the cached objects
+        return copy.deepcopy(res)
 
     def annotate_curie(self, curie, raw=False, fields=None):
         """Annotate a single curie id"""
@@ -459,7 +558,7 @@ class Annotator:
         ####
         return res_by_id
 
-    def annotate_trapi(self, trapi_input, append=False, raw=False, fields=None, limit=None):
+    async def annotate_trapi(self, trapi_input, append=False, raw=False, fields=None, limit=None):
         """Annotate a TRAPI input message with node annotator annotations"""
         try:
             node_d = get_dotfield_value("message.knowledge_graph.nodes", trapi_input)
@@ -479,33 +578,41 @@ class Annotator:
             node_d = _node_d
             del i, _node_d
 
+        # node_type to the list of (original node id, query id) pairs, e.g. {"gene": [("NCBIGene:1017", "1017")]}
         node_list_by_type = {}
         for node_id in node_d:
-            node_type = self.parse_curie(node_id, return_type=True, return_id=False)
+            node_type, query_id = self.parse_curie(node_id)
             if not node_type:
                 logger.warning(" Unsupported Curie prefix: %s. Skipped!", node_id)
-            if node_type:
-                if node_type not in node_list_by_type:
-                    node_list_by_type[node_type] = [node_id]
-                else:
-                    node_list_by_type[node_type].append(node_id)
+                continue
+            node_list_by_type.setdefault(node_type, []).append((node_id, query_id))
+
+        # node_type to the query_id to original ids mapping, e.g. {"gene": {"1017": ["NCBIGene:1017"]}}
+        # different curies may share the same query id (e.g. PUBCHEM.COMPOUND:2 and UNII:2), so each query id
+        # is only queried once and its result is assigned back to all of its original node ids
+        node_id_d_by_type = {}
         for node_type in node_list_by_type:
             if node_type not in self.annotator_clients or not node_list_by_type[node_type]:
                 # skip for now
                 continue
-            # this is the list of original node ids like NCBIGene:1017, should be a unique list
-            node_list = node_list_by_type[node_type]
-            # this is the list of query ids like 1017
-            query_list = [
-                self.parse_curie(_id, return_type=False, return_id=True) for _id in node_list_by_type[node_type]
-            ]
-            # query_id to original id mapping
-            node_id_d = dict(zip(query_list, node_list))
-            res_by_id = self.query_biothings(node_type, query_list, fields=fields)
+            node_id_d = node_id_d_by_type[node_type] = {}
+            for _id, query_id in node_list_by_type[node_type]:
+                node_id_d.setdefault(query_id, []).append(_id)
+
+        # the node types are queried from different APIs independently, so run the (blocking) queries concurrently
+        # in worker threads, which also keeps the IOLoop free meanwhile
+        res_by_id_list = await asyncio.gather(
+            *(
+                # the keys of node_id_d are the unique query ids like 1017
+                asyncio.to_thread(self.query_biothings, node_type, list(node_id_d), fields=fields)
+                for node_type, node_id_d in node_id_d_by_type.items()
+            )
+        )
+
+        for (node_type, node_id_d), res_by_id in zip(node_id_d_by_type.items(), res_by_id_list):
             if not raw:
                 res_by_id = self.transform(res_by_id, node_type)
             for node_id in res_by_id:
-                orig_node_id = node_id_d[node_id]
                 res = res_by_id[node_id]
                 # if not raw:
                 #     if isinstance(res, list):
@@ -513,16 +620,17 @@ class Annotator:
                 #         res = [self.transform(r) for r in res]
                 #     else:
                 #         res = self.transform(res)
-                res = {
-                    "attribute_type_id": "biothings_annotations",
-                    "value": res,
-                }
-                if append:
-                    # append annotations to existing "attributes" field
-                    node_d[orig_node_id]["attributes"].append(res)
-                else:
-                    # return annotations only
-                    node_d[orig_node_id]["attributes"] = [res]
+                for orig_node_id in node_id_d[node_id]:
+                    attribute = {
+                        "attribute_type_id": "biothings_annotations",
+                        "value": res,
+                    }
+                    if append:
+                        # append annotations to existing "attributes" field
+                        node_d[orig_node_id]["attributes"].append(attribute)
+                    else:
+                        # return annotations only
+                        node_d[orig_node_id]["attributes"] = [attribute]
 
         return node_d
 
@@ -557,7 +665,7 @@ class AnnotatorHandler(BaseAPIHandler):
     async def post(self, *args, **kwargs):
         annotator = Annotator()
         try:
-            annotated_node_d = annotator.annotate_trapi(
+            annotated_node_d = await annotator.annotate_trapi(
                 self.args_json,
                 append=self.args.append,
                 raw=self.args.raw,
@@ -1,6 +1,8 @@
 import asyncio
+import os
 
 from enum import Flag, auto
+from pathlib import Path
 from biothings.web.handlers.query import BaseAPIHandler
 
 from web.utils import NGDZeroDocFreqException, UNDEFINED_STR
@@ -79,7 +81,14 @@ class SemmedNGDHandler(BaseAPIHandler):
     }
 
     # Suppose each term ID is an 8-char string and each doc freq is an integer. An OrderedDict of size 102400 takes ~10MB in RAM
-    doc_stats_cache = DocStatsCache(unary_capacity=102400, bipartite_capacity=102400)
+    # The total number of docs is also persisted on disk for a day, so that new worker processes don't need to run the
+    # aggregation over the whole index again. (`Path.cwd()` is the "pending.api" folder, see config_web/semmeddb.py)
+    doc_stats_cache = DocStatsCache(
+        unary_capacity=102400,
+        bipartite_capacity=102400,
+        doc_total_filepath=os.path.join(Path.cwd(), ".cache", "semmeddb_doc_total.json"),
+        doc_total_ttl=86400,
+    )
     ngd_cache = NGDCache(capacity=102400)
 
     def initialize(
@@ -1,3 +1,7 @@
+import json
+import logging
+import os
+import time
 from typing import Union, List
 from abc import ABC, abstractmethod
 
@@ -7,6 +11,8 @@ from elasticsearch_dsl import Search, Q, A
 from web.utils import LRUCache
 from web.utils import normalized_google_distance, INFINITY_STR, NGDZeroDocFreqException, NGDInfinityException
 
+logger = logging.getLogger(__name__)
+
 
 class CacheKeyable:
     def __init__(self, cache_key):
@@ -110,9 +116,10 @@ class DocStatsService:
         self.object_field_name = object_field_name  # e.g. "object.umls"
         self.doc_freq_agg_name = doc_freq_agg_name  # e.g. "sum_of_predication_counts"
 
-    async def _query_doc_freq_in_es(self, search: Search) -> int:
+    async def _query_doc_freq_in_es(self, search: Search, search_params: dict = None) -> int:
         """
         Query the search object to ES and parse the aggregation value in the response as the document frequency.
+        `search_params`, if given, are passed to the ES client as URL parameters (e.g. `request_cache`).
 
         The response structure is like:
 
@@ -130,7 +137,9 @@ class DocStatsService:
                 }
             }
         """
-        resp = await self.es_async_client.search(body=search.to_dict(), index=self.es_index_name)
+        resp = await self.es_async_client.search(
+            body=search.to_dict(), index=self.es_index_name, **(search_params or {})
+        )
 
         if "aggregations" not in resp:
             raise ValueError(
@@ -242,10 +251,14 @@ class DocStatsService:
 
     async def doc_total(self) -> int:
         # This search is essentially a doc_freq search without any filter on terms
-        search = Search().extra(size=0)
+        # size=0 + aggregation is exactly what the ES shard request cache serves; force the cache on (instead of
+        # depending on the index settings), skip hit counting, and use a fixed `preference` string so that repeated
+        # calls are routed to the same shard copies and hit their caches
+        search = Search().extra(size=0, track_total_hits=False)
+        search_params = {"request_cache": True, "preference": "doc_total"}
         _agg = A("sum", field="predication_count")
         search.aggs.metric(self.doc_freq_agg_name, _agg)
-        total = await self._query_doc_freq_in_es(search)
+        total = await self._query_doc_freq_in_es(search, search_params)
         return total
 
 
@@ -269,21 +282,57 @@ class DocStatsCache:
     A cache class to store the document frequencies, which include:
 
     1. An integer cache for total number of docs.
+       If `doc_total_filepath` is set, this value is also persisted to that JSON file, so other processes (and restarts)
+       can read it instead of querying ES again, until the file is older than `doc_total_ttl` seconds. The file also
+       records the ES index the value was counted from, and is ignored when read for another index.
     2. An LRU cache for unary doc frequencies.
     3. An LRU cache for bipartite doc frequencies.
     """
 
-    def __init__(self, unary_capacity, bipartite_capacity):
+    def __init__(self, unary_capacity, bipartite_capacity, doc_total_filepath: str = None, doc_total_ttl: int = 86400):
         self.total_cache: int = None
+        self.doc_total_filepath = doc_total_filepath
+        self.doc_total_ttl = doc_total_ttl
 
         self.unary_cache = LRUCache(unary_capacity)
         self.bipartite_cache = LRUCache(bipartite_capacity)
 
-    def read_doc_total(self):
+    def read_doc_total(self, es_index_name: str = None):
+        if self.total_cache is None and self.doc_total_filepath is not None:
+            self.total_cache = self._read_doc_total_file(es_index_name)
         return self.total_cache
 
-    def write_doc_total(self, total):
+    def write_doc_total(self, total, es_index_name: str = None):
         self.total_cache = total
+        if self.doc_total_filepath is not None:
+            self._write_doc_total_file(total, es_index_name)
+
+    def _read_doc_total_file(self, es_index_name):
+        """
+        Return the total number of docs of `es_index_name` persisted in `self.doc_total_filepath`,
+        or None if the file is missing, expired, invalid or written for another index.
+        """
+        try:
+            if time.time() - os.path.getmtime(self.doc_total_filepath) > self.doc_total_ttl:
+                return None
+            with open(self.doc_total_filepath, "r") as fd:
+                content = json.load(fd)
+            if content.get("es_index") != es_index_name:
+                return None
+            return int(content["doc_total"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def _write_doc_total_file(self, total, es_index_name):
+        # write to a temporary file first then rename it, so readers never see a partially written file
+        tmp_filepath = f"{self.doc_total_filepath}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.doc_total_filepath), exist_ok=True)
+            with open(tmp_filepath, "w") as fd:
+                json.dump({"es_index": es_index_name, "doc_total": total}, fd)
+            os.replace(tmp_filepath, self.doc_total_filepath)
+        except OSError as e:
+            logger.warning("Cannot persist the total number of docs to %s: %s", self.doc_total_filepath, e)
 
     def read_unary_doc_freq(self, key) -> int:
         return self.unary_cache.get(key)
@@ -350,12 +399,12 @@ class NGDService:
         Get the total number of documents in the index. This value will be cached, otherwise a query to self.doc_stats_service will be made to init this value.
         """
         if read_cache:
-            cached_total = self.doc_stats_cache.read_doc_total()
+            cached_total = self.doc_stats_cache.read_doc_total(self.doc_stats_service.es_index_name)
             if cached_total is not None:
                 return cached_total
 
         total = await self.doc_stats_service.doc_total()
-        self.doc_stats_cache.write_doc_total(total)
+        self.doc_stats_cache.write_doc_total(total, self.doc_stats_service.es_index_name)
 
         return total
 
@@ -1,7 +1,13 @@
 import abc
 import json
+import mmap
 from typing import List
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .ngd_service import TermExpansionService
 
 
@@ -27,10 +33,16 @@ class UMLSJsonFileClient(UMLSResourceClient):
 
     def open_resource(self):
         if self.handler is None:
-            self.handler = open(self.filepath, "r")
+            self.handler = open(self.filepath, "rb")
 
         if self.data is None:
-            self.data = json.load(self.handler)
+            if orjson is not None:
+                # parse straight from the memory-mapped file (no copy into a Python bytes/str object first)
+                with mmap.mmap(self.handler.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    with memoryview(buffer) as view:
+                        self.data = orjson.loads(view)
+            else:
+                self.data = json.load(self.handler)
 
     def close_resource(self):
         if self.handler is not None:
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import urllib3
+
+# A process-wide connection pool, so repeated downloads reuse TCP/TLS connections (keep-alive)
+# instead of paying a fresh handshake per request. The timeouts make a stalled connection fail with an
+# `urllib3.exceptions.HTTPError`, so that callers can fall back to their local copy instead of hanging.
+HTTP_POOL = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=8,
+    retries=urllib3.Retry(3, backoff_factor=0.2),
+    timeout=urllib3.Timeout(connect=10, read=60),
+)
+
+
+def download_file(url: str, filepath: str, chunk_size: int = 1 << 20, conditional: bool = False) -> bool:
+    """
+    Stream the content at `url` into `filepath` in `chunk_size` blocks, without loading the whole body in memory.
+
+    The content is written to a temporary sibling file first and then renamed to `filepath`, so `filepath` is never
+    left partially written (e.g. by a crash in the middle of the download).
+
+    If `conditional` is True, the ETag of the downloaded content is kept in "<filepath>.etag", and the next calls send
+    it in a "If-None-Match" header, so the content is only downloaded again when it has changed on the server.
+
+    Return True if `filepath` was (re)written, or False if it was already up to date.
+    """
+    etag_filepath = f"{filepath}.etag"
+    headers = {}
+    if conditional and os.path.exists(filepath) and os.path.exists(etag_filepath):
+        with open(etag_filepath, "r") as etag_file:
+            headers["If-None-Match"] = etag_file.read().strip()
+
+    response = HTTP_POOL.request("GET", url, headers=headers, preload_content=False)
+    try:
+        if response.status == 304:
+            return False
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError(f"GET {url} failed with status {response.status}")
+
+        # pid in the name so that concurrent processes don't write into the same temporary file
+        tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filepath, "wb") as local_file:
+                shutil.copyfileobj(response, local_file, chunk_size)
+                local_file.flush()
+                os.fsync(local_file.fileno())
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            # e.g. a read timeout in the middle of the download
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+        etag = response.headers.get("ETag")
+    finally:
+        response.release_conn()
+
+    if conditional:
+        if etag:
+            with open(etag_filepath, "w") as etag_file:
+                etag_file.write(etag)
+        elif os.path.exists(etag_filepath):
+            os.remove(etag_filepath)
+    return True